@@ -14,6 +14,7 @@
 # limitations under the License.
 
 """Contrastive RL learner implementation."""
+import functools
 import time
 from typing import NamedTuple, Optional
 
@@ -41,6 +42,58 @@ class TrainingState(NamedTuple):
     alpha_params: Optional[networks_lib.Params] = None
 
 
+@functools.lru_cache()
+def _eye(n):
+    """Host-side identity labels for the InfoNCE losses.
+
+    Batch shapes are fixed for the whole run, so the labels are built once
+    with NumPy and embedded in the compiled step as a literal instead of an
+    iota/compare pair re-emitted on every trace.
+    """
+    return np.eye(n, dtype=np.float32)
+
+
+def _tiled_logsumexp(logits, num_tiles=4):
+    """Computes logsumexp over axis 1 by streaming column tiles.
+
+    Scans the (B, B, ...) logits one (B, B // num_tiles, ...) tile at a time,
+    carrying a running max / sum-of-exp pair, so only one tile of
+    exponentials is live in memory. The tile body is checkpointed so the
+    backward pass recomputes tile exponentials instead of storing them.
+    """
+    batch_size = logits.shape[1]
+    if num_tiles <= 1 or batch_size % num_tiles:
+        return jax.nn.logsumexp(logits, axis=1)
+    tiles = jnp.stack(jnp.split(logits, num_tiles, axis=1))
+
+    @jax.checkpoint
+    def accumulate(carry, tile):
+        running_max, running_sum = carry
+        new_max = jnp.maximum(running_max, jnp.max(tile, axis=1))
+        tile_sum = jnp.sum(jnp.exp(tile - new_max[:, None]), axis=1)
+        running_sum = running_sum * jnp.exp(running_max - new_max) + tile_sum
+        return (new_max, running_sum), ()
+
+    carry_shape = logits.shape[:1] + logits.shape[2:]
+    init = (jnp.full(carry_shape, -jnp.inf, dtype=logits.dtype),
+            jnp.zeros(carry_shape, dtype=logits.dtype))
+    (running_max, running_sum), _ = jax.lax.scan(accumulate, init, tiles)
+    return running_max + jnp.log(running_sum)
+
+
+def _bf16_q_apply(apply_fn, params, *args):
+    """Runs a critic forward pass in bf16 and returns fp32 logits.
+
+    Parameters and inputs are cast to bf16 so the matmuls hit the tensor
+    cores at half the bandwidth; the logits are cast back to fp32 before
+    any softmax / cross-entropy so the loss arithmetic keeps full
+    precision. Master weights and optimizer state stay fp32.
+    """
+    to_bf16 = lambda t: t.astype(jnp.bfloat16) if t.dtype == jnp.float32 else t
+    params, args = jax.tree_map(to_bf16, (params, list(args)))
+    return apply_fn(params, *args).astype(jnp.float32)
+
+
 class ContrastiveLearner(acme.Learner):
     """Contrastive RL learner."""
 
@@ -73,6 +126,13 @@ class ContrastiveLearner(acme.Learner):
         if config.add_mc_to_td:
             assert config.use_td
         adaptive_entropy_coefficient = config.entropy_coefficient is None
+        num_devices = jax.local_device_count()
+        self._num_devices = num_devices
+        # The multi-device path only exists when the step is pmapped below;
+        # with config.jit disabled the state stays unreplicated and no 'i'
+        # axis is bound for pmean, regardless of the device count.
+        use_pmap = config.jit and num_devices > 1
+        self._use_pmap = use_pmap
         self._num_sgd_steps_per_step = config.num_sgd_steps_per_step
         self._obs_dim = config.obs_dim
         self._use_td = config.use_td
@@ -87,41 +147,45 @@ class ContrastiveLearner(acme.Learner):
                 raise ValueError('target_entropy should not be set when '
                                  'entropy_coefficient is provided')
 
-        def alpha_loss(log_alpha,
-                       policy_params,
-                       transitions,
-                       key):
-            """Eq 18 from https://arxiv.org/pdf/1812.05905.pdf."""
-
-            state = transitions.observation[:, 0, :config.obs_dim]
-            goal = transitions.observation[:, 1, :config.obs_dim]
-
-            dist_params = networks.policy_network.apply(
-                policy_params, jnp.concatenate([state, goal], axis=-1))
-            action = networks.sample(dist_params, key)
-            log_prob = networks.log_prob(dist_params, action)
+        # Rematerialize the critic forward in the backward pass: only the
+        # contraction outputs are saved, so activation memory stops scaling
+        # with the MLP depth and larger contrastive batches fit on device.
+        # The target-network forward feeds a stop_gradient and needs no
+        # checkpointing.
+        q_apply = jax.checkpoint(
+            networks.q_network.apply,
+            policy=jax.checkpoint_policies.checkpoint_dots_with_no_batch_dims)
+
+        def alpha_loss(log_alpha, action_log_prob):
+            """Eq 18 from https://arxiv.org/pdf/1812.05905.pdf.
+
+            The policy sample comes from the stacked forward pass in
+            joint_loss, shared with the critic's next-action sample.
+            """
             alpha = jnp.exp(log_alpha)
             alpha_loss = alpha * jax.lax.stop_gradient(
-                -log_prob - config.target_entropy)
+                -action_log_prob - config.target_entropy)
             return jnp.mean(alpha_loss)
 
         def critic_loss(q_params,
-                        policy_params,
                         target_q_params,
                         transitions,
-                        key):
-            batch_size = transitions.observation.shape[0]
+                        next_a):
+            batch_size = transitions.observation.shape[1]
             # Note: We might be able to speed up the computation for some of the
             # baselines to making a single network that returns all the values. This
             # avoids computing some of the underlying representations multiple times.
             if config.use_td:
                 # For TD learning, the diagonal elements are the immediate next state.
-                # s, g = jnp.split(transitions.observation[:, 0], [config.obs_dim], axis=1)
-                s, _ = jnp.split(transitions.observation[:, 0], [config.obs_dim], axis=1)
-                g, _ = jnp.split(transitions.observation[:, 1], [config.obs_dim], axis=1)
+                # Only the state half of the observation is used; slicing it off
+                # directly avoids materializing the discarded goal half.
+                def head(obs):
+                    return obs[..., :config.obs_dim]
+
+                s = head(transitions.observation[0])
+                g = head(transitions.observation[1])
                 # g = jnp.roll(g, 1, axis=0)
-                next_s, _ = jnp.split(transitions.next_observation[:, 0], [config.obs_dim],
-                                      axis=1)
+                next_s = head(transitions.next_observation[0])
                 # if config.add_mc_to_td:
                 #     next_fraction = (1 - config.discount) / ((1 - config.discount) + 1)
                 #     num_next = int(batch_size * next_fraction)
@@ -133,7 +197,7 @@ class ContrastiveLearner(acme.Learner):
                 #     new_g = obs_to_goal(next_s)
                 # obs = jnp.concatenate([s, new_g], axis=1)
                 # transitions = transitions._replace(observation=obs)
-            I = jnp.eye(batch_size)  # pylint: disable=invalid-name
+            I = _eye(batch_size)  # pylint: disable=invalid-name
             # logits = networks.q_network.apply(
             #     q_params, transitions.observation, transitions.action)
             # logits = networks.q_network.apply(
@@ -150,8 +214,14 @@ class ContrastiveLearner(acme.Learner):
             # pos_logits = networks.q_network.apply(
             #     q_params, s, transitions.action, next_s, next_s)
             # c-learning for arbitrary fs, TD-InfoNCE
-            pos_logits = networks.q_network.apply(
-                q_params, s, transitions.action[:, 0], g, next_s)
+            # The (s, a, g) tower is shared by the positive and negative
+            # logits, so evaluate it once against the concatenation of the two
+            # future-state batches and split the outer product afterwards.
+            rand_g = jnp.roll(g, -1, axis=0)
+            logits = _bf16_q_apply(
+                q_apply, q_params, s, transitions.action[0],
+                g, jnp.concatenate([next_s, rand_g], axis=0))
+            pos_logits, neg_logits = jnp.split(logits, 2, axis=1)
             # pos_logits = jnp.einsum('ijk,ij->ik', logits, transitions.action)
 
             if config.use_td:
@@ -165,8 +235,6 @@ class ContrastiveLearner(acme.Learner):
                 # s, g = jnp.split(transitions.observation, [config.obs_dim], axis=1)
                 # del s
                 # next_s = transitions.next_observation[:, 0, :config.obs_dim]
-                goal_indices = jnp.roll(jnp.arange(batch_size, dtype=jnp.int32), -1)
-                rand_g = g[goal_indices]
                 # rand_g, _ = jnp.split(transitions.observation[:, 2], [config.obs_dim], axis=1)
                 # rand_g = transitions.observation[:, 1, :config.obs_dim]
                 # transitions = transitions._replace(
@@ -174,19 +242,9 @@ class ContrastiveLearner(acme.Learner):
                 # c-learning
                 # next_dist_params = networks.policy_network.apply(
                 #     policy_params, jnp.concatenate([next_s, rand_g], axis=1))
-                # c-learning for arbitrary fs, TD-InfoNCE
-                next_dist_params = networks.policy_network.apply(
-                    policy_params, jnp.concatenate([next_s, g], axis=-1))
-
-                # discrete environment
-                # c = next_dist_params.cumsum(axis=1)
-                # u = jax.random.uniform(key, shape=(len(c), 1))
-                # next_a = (u < c).argmax(axis=1)
-                # next_a = jax.nn.one_hot(next_a, 5)
-
-                # continuous environment
-                # key, subkey = jax.random.split(key)
-                next_a = networks.sample(next_dist_params, key)
+                # c-learning for arbitrary fs, TD-InfoNCE: next_a comes out of
+                # the stacked policy forward in joint_loss, shared with the
+                # alpha term's sample.
 
                 # next_action = networks.sample(next_dist_params, key)
                 # index = next_action.argmax(axis=-1)
@@ -203,8 +261,9 @@ class ContrastiveLearner(acme.Learner):
                 # next_q = networks.q_network.apply(target_q_params,
                 #                                   next_s, next_a, rand_g, rand_g)
                 # c-learning for arbitrary fs, TD-InfoNCE
-                next_q = networks.q_network.apply(target_q_params,
-                                                  next_s, next_a, g, rand_g)
+                next_q = _bf16_q_apply(networks.q_network.apply,
+                                       target_q_params, next_s, next_a, g,
+                                       rand_g)
 
                 # # next_q = networks.q_network.apply(target_q_params, next_s, next_action, rand_g, rand_g)
                 # # next_q = jax.nn.sigmoid(next_q)
@@ -226,15 +285,18 @@ class ContrastiveLearner(acme.Learner):
                 # # w = jnp.einsum('ij,ij->i', w, next_action)
                 # # (B, B, 2) --> (B, 2), computes diagonal of each twin Q.
 
-                # TD-InfoNCE w
-                next_v = jnp.min(next_q, axis=-1)
+                # TD-InfoNCE w. Stopping the gradient on next_v up front
+                # keeps the whole weight computation out of the backward
+                # graph, and exponentiating the log-softmax is one fused
+                # kernel instead of a softmax plus normalization round-trip.
+                next_v = jax.lax.stop_gradient(jnp.min(next_q, axis=-1))
                 if config.use_arbitrary_func_reg:
-                    w = jnp.exp(next_v) / batch_size
+                    # exp(v) / B == exp(v - log B): no separate divide.
+                    w = jnp.exp(next_v - jnp.log(batch_size))
                     # w = jnp.exp(next_v)
                 else:
-                    w = jax.nn.softmax(next_v, axis=1)
+                    w = jnp.exp(jax.nn.log_softmax(next_v, axis=1))  # (B, B)
                     # w = batch_size * jax.nn.softmax(next_v, axis=1)
-                w = jax.lax.stop_gradient(w)  # (B, B)
 
                 # A_phi_psi
                 # pos_logits = jax.vmap(jnp.diag, -1, -1)(pos_logits)
@@ -242,16 +304,18 @@ class ContrastiveLearner(acme.Learner):
                 #     logits=pos_logits, labels=1)  # [B, 2]
 
                 # TD-InfoNCE
-                I = I[:, :, None].repeat(pos_logits.shape[-1], axis=-1)
-                loss_pos = jax.vmap(optax.softmax_cross_entropy, -1, -1)(
-                    pos_logits, I)
+                # The cross entropy against the identity labels reduces to
+                # logsumexp(row) - diagonal, so stream the logsumexp in tiles
+                # instead of materializing the (B, B, 2) labels.
+                pos_diag = jnp.diagonal(pos_logits, axis1=0, axis2=1).T
+                loss_pos = _tiled_logsumexp(pos_logits) - pos_diag
 
                 # neg_logits = logits[jnp.arange(batch_size), goal_indices]
                 # neg_logits = networks.q_network.apply(q_params, s, transitions.action, g, rand_g)
                 # c-learning
                 # neg_logits = networks.q_network.apply(q_params, s, transitions.action, rand_g, rand_g)
-                # c-learning for arbitrary fs, TD-InfoNCE
-                neg_logits = networks.q_network.apply(q_params, s, transitions.action[:, 0], g, rand_g)
+                # c-learning for arbitrary fs, TD-InfoNCE: neg_logits comes out
+                # of the fused q_network application above.
 
                 # # neg_logits = jnp.einsum('ijk,ij->ik', neg_logits, transitions.action)
                 # # A_phi_psi
@@ -269,14 +333,20 @@ class ContrastiveLearner(acme.Learner):
                 #             + config.discount * loss_neg1 + loss_neg2)
 
                 # TD-InfoNCE loss
-                loss_neg = jax.vmap(optax.softmax_cross_entropy, -1, -1)(
-                    neg_logits, w[:, :, None].repeat(neg_logits.shape[-1], axis=-1))
+                # The logsumexp over negatives is computed once and shared:
+                # it normalizes the log-softmax here and feeds the
+                # regularizer below, so the (B, B, 2) tensor is reduced a
+                # single time. The twin-Q axis rides along in the sum, so no
+                # vmap and no repeated weight tensor.
+                lse_neg = _tiled_logsumexp(neg_logits)  # (B, 2)
+                log_softmax_neg = neg_logits - lse_neg[:, None]
+                loss_neg = -jnp.sum(w[:, :, None] * log_softmax_neg, axis=1)
 
                 loss = (1 - config.discount) * loss_pos + config.discount * loss_neg
 
                 if config.use_arbitrary_func_reg:
                     # regularization
-                    reg = jnp.mean((jax.nn.logsumexp(neg_logits, axis=1) - jnp.log(batch_size)) ** 2)
+                    reg = jnp.mean((lse_neg - jnp.log(batch_size)) ** 2)
                     reg_loss = config.arbitrary_func_reg_coef * reg
                     loss += jnp.mean(reg_loss)
                 else:
@@ -310,24 +380,20 @@ class ContrastiveLearner(acme.Learner):
             #     logsumexp = jax.nn.logsumexp(logits[:, :, 0], axis=1) ** 2
             # else:
             #     logsumexp = jax.nn.logsumexp(logits, axis=1) ** 2
-            metrics = {
+            # Return the raw tensors; the scalar summaries are reduced in
+            # update_step, outside the differentiated function, so the metric
+            # reductions never enter the backward graph.
+            aux = {
                 # 'binary_accuracy': jnp.mean((logits > 0) == I),
                 # 'categorical_accuracy': jnp.mean(correct),
-                'logits_pos': jnp.mean(jax.vmap(jnp.diag, -1, -1)(pos_logits)),
-                'logits_pos1': jnp.mean(jnp.diag(pos_logits[..., 0])),
-                'logits_pos2': jnp.mean(jnp.diag(pos_logits[..., 1])),
-                'logits_neg': jnp.mean(neg_logits),
-                'logits_neg1': jnp.mean(neg_logits[..., 0]),
-                'logits_neg2': jnp.mean(neg_logits[..., 1]),
+                'pos_diag': pos_diag,
+                'neg_logits': neg_logits,
                 # 'logsumexp': logsumexp.mean(),
-                # 'w': jnp.mean(w),
-                # 'w': jnp.mean(jnp.exp(next_q)),
-                'w': jnp.mean(jnp.diag(w)),
-                'w_mean': jnp.mean(w),
-                "reg_loss": jnp.mean(reg_loss),
+                'w': w,
+                'reg_loss': reg_loss,
             }
 
-            return loss, metrics
+            return loss, aux
 
         def actor_loss(policy_params,
                        q_params,
@@ -337,13 +403,19 @@ class ContrastiveLearner(acme.Learner):
                        ):
             obs = transitions.observation
             if config.use_gcbc:
+                # Fold the pair axis into the batch so gcbc trains on both
+                # halves of the paired batch; using only pair 0 would halve
+                # the effective batch size relative to the unpaired learner.
+                gcbc_obs = obs.reshape((-1,) + obs.shape[2:])
+                gcbc_action = transitions.action.reshape(
+                    (-1,) + transitions.action.shape[2:])
                 dist_params = networks.policy_network.apply(
-                    policy_params, obs)
-                log_prob = networks.log_prob(dist_params, transitions.action)
+                    policy_params, gcbc_obs)
+                log_prob = networks.log_prob(dist_params, gcbc_action)
                 actor_loss = -1.0 * jnp.mean(log_prob)
             else:
-                state = obs[:, 0, :config.obs_dim]
-                goal = obs[:, 0, config.obs_dim:]
+                state = obs[0, :, :config.obs_dim]
+                goal = obs[0, :, config.obs_dim:]
 
                 # state = obs[:, 0, :config.obs_dim]
                 # goal = obs[:, 1, :config.obs_dim]
@@ -386,8 +458,9 @@ class ContrastiveLearner(acme.Learner):
                 #     q_params, new_obs, action)
                 # q_action = networks.q_network.apply(
                 #     q_params, new_state, hard_action, new_goal, new_goal)
-                q_action = networks.q_network.apply(
-                    q_params, new_state, action, new_goal, new_goal)
+                q_action = _bf16_q_apply(
+                    q_apply, q_params, new_state, action,
+                    new_goal, new_goal)
                 # predict logits
                 # if len(q_action.shape) == 2:  # twin q trick
                 # A_phi_psi
@@ -407,13 +480,13 @@ class ContrastiveLearner(acme.Learner):
                 if config.use_arbitrary_func_reg:
                     actor_q_loss = -jnp.diag(q_action)
                 else:
-                    I = jnp.eye(batch_size)
+                    I = _eye(batch_size)
                     actor_q_loss = optax.softmax_cross_entropy(logits=q_action, labels=I)
                 actor_loss = alpha * log_prob + actor_q_loss  # (B, num_actions)
 
                 assert 0.0 <= config.bc_coef <= 1.0
                 if config.bc_coef > 0:
-                    orig_action = transitions.action
+                    orig_action = transitions.action[0]
                     if config.random_goals == 0.5:
                         orig_action = jnp.concatenate([orig_action, orig_action], axis=0)
 
@@ -423,31 +496,101 @@ class ContrastiveLearner(acme.Learner):
 
             return jnp.mean(actor_loss)
 
-        alpha_grad = jax.value_and_grad(alpha_loss)
-        critic_grad = jax.value_and_grad(critic_loss, has_aux=True)
-        actor_grad = jax.value_and_grad(actor_loss)
+        def joint_loss(policy_params,
+                       q_params,
+                       log_alpha,
+                       target_q_params,
+                       transitions,
+                       key_policy,
+                       key_actor):
+            """Sums the three losses so one value_and_grad covers them.
+
+            Each term sees only its own parameters as differentiable; the
+            cross-term parameters are stop_gradient'ed, so the summed
+            gradients match the three separate gradient calls while XLA gets
+            one graph and can share the common forward passes.
+            """
+            frozen_policy_params = jax.lax.stop_gradient(policy_params)
+            frozen_q_params = jax.lax.stop_gradient(q_params)
+
+            # The alpha and critic terms both sample the frozen policy on a
+            # B-row goal-conditioned input, so one stacked forward pass and
+            # one sample serve both. The actor keeps its own forward: it
+            # differentiates through the policy and its batch may be
+            # goal-relabelled to a different size.
+            state = transitions.observation[0, :, :config.obs_dim]
+            goal = transitions.observation[1, :, :config.obs_dim]
+            batch_size = state.shape[0]
+            sample_next_a = config.use_td and not config.use_gcbc
+            policy_inputs = []
+            if adaptive_entropy_coefficient:
+                policy_inputs.append(jnp.concatenate([state, goal], axis=-1))
+            if sample_next_a:
+                next_s = transitions.next_observation[0, :, :config.obs_dim]
+                policy_inputs.append(jnp.concatenate([next_s, goal], axis=-1))
+            if policy_inputs:
+                dist_params = networks.policy_network.apply(
+                    frozen_policy_params,
+                    jnp.concatenate(policy_inputs, axis=0))
+                sampled_actions = networks.sample(dist_params, key_policy)
+            next_a = sampled_actions[-batch_size:] if sample_next_a else None
+
+            if adaptive_entropy_coefficient:
+                # Only the alpha term consumes a log_prob, so evaluate it on
+                # its B rows alone (tfd distributions support batch slicing);
+                # the next-action rows skip the tanh-Jacobian arithmetic that
+                # the target critic path would just discard.
+                log_prob = networks.log_prob(dist_params[:batch_size],
+                                             sampled_actions[:batch_size])
+                alpha_loss_ = alpha_loss(log_alpha, log_prob)
+                alpha = jnp.exp(jax.lax.stop_gradient(log_alpha))
+            else:
+                alpha_loss_ = 0.0
+                alpha = config.entropy_coefficient
+
+            if config.use_gcbc:
+                critic_loss_ = 0.0
+                critic_aux = {}
+            else:
+                critic_loss_, critic_aux = critic_loss(
+                    q_params, target_q_params, transitions, next_a)
+
+            actor_loss_ = actor_loss(policy_params, frozen_q_params, alpha,
+                                     transitions, key_actor)
+
+            loss = critic_loss_ + actor_loss_ + alpha_loss_
+            return loss, (critic_loss_, actor_loss_, alpha_loss_, critic_aux)
+
+        joint_grad = jax.value_and_grad(joint_loss, argnums=(0, 1, 2),
+                                        has_aux=True)
 
         def update_step(
                 state,
                 transitions,
         ):
 
-            key, key_alpha, key_critic, key_actor = jax.random.split(state.key, 4)
+            # fold_in derives each per-loss key with a single hash of the
+            # state key instead of allocating a key tensor via split.
+            key_policy = jax.random.fold_in(state.key, 0)
+            key_actor = jax.random.fold_in(state.key, 1)
+            key = jax.random.fold_in(state.key, 2)
             if adaptive_entropy_coefficient:
-                alpha_loss, alpha_grads = alpha_grad(state.alpha_params,
-                                                     state.policy_params, transitions,
-                                                     key_alpha)
-                alpha = jnp.exp(state.alpha_params)
+                log_alpha = state.alpha_params
             else:
-                alpha = config.entropy_coefficient
-
-            if not config.use_gcbc:
-                (critic_loss, critic_metrics), critic_grads = critic_grad(
-                    state.q_params, state.policy_params, state.target_q_params,
-                    transitions, key_critic)
-
-            actor_loss, actor_grads = actor_grad(state.policy_params, state.q_params,
-                                                 alpha, transitions, key_actor)
+                # Unused placeholder; its gradient is discarded.
+                log_alpha = jnp.zeros(())
+
+            (_, (critic_loss, actor_loss, alpha_loss, critic_aux)), grads = (
+                joint_grad(state.policy_params, state.q_params, log_alpha,
+                           state.target_q_params, transitions, key_policy,
+                           key_actor))
+            actor_grads, critic_grads, alpha_grads = grads
+            if use_pmap:
+                # Each device computed gradients on its own batch shard;
+                # average them so every replica applies the same update.
+                grads = jax.lax.pmean((actor_grads, critic_grads, alpha_grads),
+                                      axis_name='i')
+                actor_grads, critic_grads, alpha_grads = grads
 
             # Apply policy gradients
             actor_update, policy_optimizer_state = policy_optimizer.update(
@@ -457,7 +600,6 @@ class ContrastiveLearner(acme.Learner):
             # Apply critic gradients
             if config.use_gcbc:
                 metrics = {}
-                critic_loss = 0.0
                 q_params = state.q_params
                 q_optimizer_state = state.q_optimizer_state
                 new_target_q_params = state.target_q_params
@@ -467,10 +609,28 @@ class ContrastiveLearner(acme.Learner):
 
                 q_params = optax.apply_updates(state.q_params, critic_update)
 
-                new_target_q_params = jax.tree_map(
-                    lambda x, y: x * (1 - config.tau) + y * config.tau,
-                    state.target_q_params, q_params)
-                metrics = critic_metrics
+                # Target params stay fp32: with tau = 0.005 a bf16 Polyak
+                # accumulator underflows and freezes the target network.
+                # _bf16_q_apply already casts per forward, which is where
+                # the bandwidth win lives.
+                new_target_q_params = optax.incremental_update(
+                    q_params, state.target_q_params, config.tau)
+                # jnp.diagonal is a strided view, so one read covers both
+                # twin-Q diagonals without a vmapped gather per head.
+                pos_diag = critic_aux['pos_diag']
+                neg_logits = critic_aux['neg_logits']
+                w = critic_aux['w']
+                metrics = {
+                    'logits_pos': jnp.mean(pos_diag),
+                    'logits_pos1': jnp.mean(pos_diag[:, 0]),
+                    'logits_pos2': jnp.mean(pos_diag[:, 1]),
+                    'logits_neg': jnp.mean(neg_logits),
+                    'logits_neg1': jnp.mean(neg_logits[..., 0]),
+                    'logits_neg2': jnp.mean(neg_logits[..., 1]),
+                    'w': jnp.mean(jnp.diagonal(w)),
+                    'w_mean': jnp.mean(w),
+                    'reg_loss': jnp.mean(critic_aux['reg_loss']),
+                }
 
             metrics.update({
                 'critic_loss': critic_loss,
@@ -506,14 +666,57 @@ class ContrastiveLearner(acme.Learner):
             'learner', asynchronous=True, serialize_fn=utils.fetch_devicearray,
             time_delta=10.0)
 
-        # Iterator on demonstration transitions.
-        self._iterator = iterator
-
-        update_step = utils.process_multiple_batches(update_step,
-                                                     config.num_sgd_steps_per_step)
-        # Use the JIT compiler.
-        if config.jit:
-            self._update_step = jax.jit(update_step)
+        # Iterator on demonstration transitions. Pair two replay samples per
+        # update on the prefetch thread so the host-side stacking and the
+        # host-to-device transfer overlap with the previous update step.
+        def paired_iterator(it):
+            while True:
+                transitions = types.Transition(*next(it).data)
+                transitions2 = types.Transition(*next(it).data)
+                # Stack on axis 0: a plain concatenation of the two
+                # contiguous batches, no per-field transpose.
+                yield jax.tree_map(lambda x, y: np.stack([x, y], axis=0),
+                                   transitions, transitions2)
+
+        # utils.prefetch only copies to device when one is given; without it
+        # the buffering is host-side and the transfer stays on the critical
+        # path. On the pmap path the batch is sharded across devices in
+        # step(), so leave it on host there.
+        self._iterator = utils.prefetch(
+            paired_iterator(iterator), buffer_size=2,
+            device=None if use_pmap else jax.local_devices()[0])
+
+        def update_steps(state, transitions):
+            """Runs num_sgd_steps_per_step updates under a single lax.scan.
+
+            One shared scan body replaces the unrolled update_step calls, so
+            the compiled step stays the same size no matter how many SGD
+            steps it folds in.
+            """
+            # Leaves arrive as [2, num_sgd_steps_per_step * B, ...]; carve the
+            # batch axis into scan minibatches of [2, B, ...].
+            batches = jax.tree_map(
+                lambda x: x.reshape(
+                    (x.shape[0], config.num_sgd_steps_per_step, -1)
+                    + x.shape[2:]).swapaxes(0, 1),
+                transitions)
+            state, metrics = jax.lax.scan(update_step, state, batches)
+            return state, jax.tree_map(jnp.mean, metrics)
+
+        update_step = update_steps
+        # Use the JIT compiler. Donating the state lets XLA update the
+        # parameters and optimizer state in place instead of allocating a
+        # fresh TrainingState every step. With more than one local device the
+        # step is pmapped instead: each device consumes its own batch shard
+        # (so the effective batch grows with the number of devices) and the
+        # gradients are pmean'd above. Note the negatives stay per-device; an
+        # all_gather of the goal representations would need the network to
+        # expose them separately.
+        if use_pmap:
+            self._update_step = jax.pmap(update_step, axis_name='i',
+                                         donate_argnums=(0,))
+        elif config.jit:
+            self._update_step = jax.jit(update_step, donate_argnums=(0,))
         else:
             self._update_step = update_step
 
@@ -542,6 +745,9 @@ class ContrastiveLearner(acme.Learner):
 
         # Create initial state.
         self._state = make_initial_state(rng)
+        if use_pmap:
+            self._state = jax.device_put_replicated(self._state,
+                                                    jax.local_devices())
 
         # Do not record timestamps until after the first learning step is done.
         # This is to avoid including the time it takes for actors to come online
@@ -550,23 +756,18 @@ class ContrastiveLearner(acme.Learner):
 
     def step(self):
         with jax.profiler.StepTraceAnnotation('step', step_num=self._counter):
-            sample = next(self._iterator)
-            transitions = types.Transition(*sample.data)
-
-            sample2 = next(self._iterator)
-            transitions2 = types.Transition(*sample2.data)
-
-            double_transitions = jax.tree_map(lambda x, y: np.stack([x, y], axis=1),
-                                              transitions, transitions2)
-
-            # sample3 = next(self._iterator)
-            # transitions3 = types.Transition(*sample3.data)
-            #
-            # triple_transitions = jax.tree_map(lambda x, y, z: np.stack([x, y, z], axis=1),
-            #                                   transitions, transitions2, transitions3)
-
+            double_transitions = next(self._iterator)
+            if self._use_pmap:
+                # Shard the batch axis across devices: [2, B, ...] ->
+                # [num_devices, 2, B / num_devices, ...].
+                double_transitions = jax.tree_map(
+                    lambda x: x.reshape(
+                        (x.shape[0], self._num_devices, -1)
+                        + x.shape[2:]).swapaxes(0, 1),
+                    double_transitions)
             self._state, metrics = self._update_step(self._state, double_transitions)
-            # self._state, metrics = self._update_step(self._state, triple_transitions)
+            if self._use_pmap:
+                metrics = utils.get_from_first_device(metrics)
 
         # Compute elapsed time.
         timestamp = time.time()
@@ -585,14 +786,24 @@ class ContrastiveLearner(acme.Learner):
         self._logger.write({**metrics, **counts})
 
     def get_variables(self, names):
+        state = self._state
+        if self._use_pmap:
+            state = utils.get_from_first_device(state)
         variables = {
-            'policy': self._state.policy_params,
-            'critic': self._state.q_params,
+            'policy': state.policy_params,
+            'critic': state.q_params,
         }
         return [variables[name] for name in names]
 
     def save(self):
-        return self._state
+        state = self._state
+        if self._use_pmap:
+            # Checkpoint an unreplicated copy so the saved state does not
+            # bake this host's device count into every leaf.
+            state = utils.get_from_first_device(state)
+        return state
 
     def restore(self, state):
+        if self._use_pmap:
+            state = jax.device_put_replicated(state, jax.local_devices())
         self._state = state
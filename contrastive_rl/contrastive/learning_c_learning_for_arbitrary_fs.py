@@ -467,16 +467,34 @@ class ContrastiveLearner(acme.Learner):
             'learner', asynchronous=True, serialize_fn=utils.fetch_devicearray,
             time_delta=10.0)
 
-        # Iterator on demonstration transitions.
-        self._iterator = iterator
-
-        update_step = utils.process_multiple_batches(update_step,
-                                                     config.num_sgd_steps_per_step)
-        # Use the JIT compiler.
+        # Iterator on demonstration transitions. Prefetch a couple of batches
+        # to device on a background thread so the host->device copy overlaps
+        # the previous update instead of sitting between SGD steps; prefetch
+        # only performs the copy when a device is given.
+        self._iterator = utils.prefetch(iterator, buffer_size=2,
+                                        device=jax.local_devices()[0])
+
+        def update_steps(state, transitions):
+            """Runs num_sgd_steps_per_step updates under a single lax.scan.
+
+            The scan compiles one loop body instead of unrolling
+            num_sgd_steps_per_step copies of update_step into the HLO.
+            """
+            batches = jax.tree_map(
+                lambda x: x.reshape(
+                    (config.num_sgd_steps_per_step, -1) + x.shape[1:]),
+                transitions)
+            state, metrics = jax.lax.scan(update_step, state, batches)
+            return state, jax.tree_map(jnp.mean, metrics)
+
+        # Use the JIT compiler. Donating the state lets XLA update the
+        # parameter and optimizer buffers in place instead of allocating a
+        # fresh TrainingState each step; step() immediately rebinds
+        # self._state, so no stale reference survives the call.
         if config.jit:
-            self._update_step = jax.jit(update_step)
+            self._update_step = jax.jit(update_steps, donate_argnums=(0,))
         else:
-            self._update_step = update_step
+            self._update_step = update_steps
 
         def make_initial_state(key):
             """Initialises the training state (parameters and optimiser state)."""
@@ -522,14 +540,13 @@ class ContrastiveLearner(acme.Learner):
 
         # Increment counts and record the current time
         counts = self._counter.increment(steps=1, walltime=elapsed_time)
-        if elapsed_time > 0:
-            metrics['steps_per_second'] = (
-                    self._num_sgd_steps_per_step / elapsed_time)
-        else:
-            metrics['steps_per_second'] = 0.
+        metrics['steps_per_second'] = (
+            self._num_sgd_steps_per_step / elapsed_time if elapsed_time else 0.)
 
-        # Attempts to write the logs.
-        self._logger.write({**metrics, **counts})
+        # Attempts to write the logs. Update the metrics dict in place
+        # instead of rebuilding it with a double splat every step.
+        metrics.update(counts)
+        self._logger.write(metrics)
 
     def get_variables(self, names):
         variables = {
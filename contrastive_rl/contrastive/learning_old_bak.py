@@ -82,7 +82,21 @@ class ContrastiveLearner(acme.Learner):
         """
         if config.add_mc_to_td:
             assert config.use_td
+        # Validate config ranges once up front rather than inside the loss
+        # functions: there the asserts only fired at trace time anyway, while
+        # cluttering the traced bodies.
+        assert 0.0 <= config.c_learning_prob <= 1.0
+        assert config.random_goals in (0.0, 0.5, 1.0)
+        assert 0.0 <= config.reverse_kl_coef <= 1.0
+        assert 0.0 <= config.bc_coef <= 1.0
         adaptive_entropy_coefficient = config.entropy_coefficient is None
+        num_devices = jax.local_device_count()
+        self._num_devices = num_devices
+        # The multi-device path only exists when the step is pmapped below;
+        # with config.jit disabled the state stays unreplicated and no 'i'
+        # axis is bound for pmean, regardless of the device count.
+        use_pmap = config.jit and num_devices > 1
+        self._use_pmap = use_pmap
         self._num_sgd_steps_per_step = config.num_sgd_steps_per_step
         self._obs_dim = config.obs_dim
         self._use_td = config.use_td
@@ -97,27 +111,31 @@ class ContrastiveLearner(acme.Learner):
                 raise ValueError('target_entropy should not be set when '
                                  'entropy_coefficient is provided')
 
+        # The oracle (teacher) branches below specialize at trace time on
+        # whether a trained learner state was provided: with no teacher the
+        # oracle forwards never enter the compiled step. Capture the value in
+        # a local so a later attribute mutation cannot go stale against the
+        # already-compiled graph.
         self._trained_learner_state = trained_learner_state
 
-        def alpha_loss(log_alpha: jnp.ndarray,
+        def alpha_loss(alpha: jnp.ndarray,
                        policy_params: networks_lib.Params,
-                       behavioral_cloning_policy_params: networks_lib.Params,
+                       bc_dist_params,
                        transitions: types.Transition,
                        key: networks_lib.PRNGKey) -> jnp.ndarray:
-            """Eq 18 from https://arxiv.org/pdf/1812.05905.pdf."""
+            """Eq 18 from https://arxiv.org/pdf/1812.05905.pdf.
+
+            Takes the already-exponentiated (differentiable) alpha so the
+            exp of log_alpha is computed once per step in joint_loss.
+            """
             dist_params = networks.policy_network.apply(
                 policy_params, transitions.observation)
             action = networks.sample(dist_params, key)
             log_prob = networks.log_prob(dist_params, action)
-            alpha = jnp.exp(log_alpha)
 
             if config.actor_loss_with_reverse_kl:
-                behavioral_cloning_dist_params = \
-                    networks.behavioral_cloning_policy_network.apply(
-                        behavioral_cloning_policy_params,
-                        transitions.observation[:, :self._obs_dim])
-                log_beta_prob = networks.log_prob(
-                    behavioral_cloning_dist_params, action)
+                # bc_dist_params is the shared BC forward from update_step.
+                log_beta_prob = networks.log_prob(bc_dist_params, action)
                 alpha_loss = alpha * jax.lax.stop_gradient(
                     log_beta_prob - log_prob - config.target_entropy)
             else:
@@ -125,6 +143,26 @@ class ContrastiveLearner(acme.Learner):
                     -log_prob - config.target_entropy)
             return jnp.mean(alpha_loss)
 
+        def bf16_q_apply(params: networks_lib.Params,
+                         obs: jnp.ndarray,
+                         action: jnp.ndarray) -> jnp.ndarray:
+            """Runs a target/oracle critic forward pass in bf16.
+
+            These outputs only pass through sigmoid/min under a stop gradient,
+            so the halved precision (and memory bandwidth) is safe; the logits
+            come back as fp32.
+            """
+            to_bf16 = lambda x: x.astype(jnp.bfloat16)
+            return networks.q_network.apply(
+                jax.tree_map(to_bf16, params), to_bf16(obs),
+                to_bf16(action)).astype(jnp.float32)
+
+        # Rematerialize the differentiated critic forward: its activations
+        # dominate memory (the output alone is [B, B, 2]), so recompute them
+        # in the backward pass instead of keeping them alive. The target and
+        # oracle forwards sit under stop gradients and are left alone.
+        q_apply_rem = jax.checkpoint(networks.q_network.apply)
+
         def critic_loss(q_params: networks_lib.Params,
                         policy_params: networks_lib.Params,
                         target_q_params: networks_lib.Params,
@@ -132,16 +170,23 @@ class ContrastiveLearner(acme.Learner):
                         transitions: types.Transition,
                         key: networks_lib.PRNGKey) -> jnp.ndarray:
             batch_size = transitions.observation.shape[0]
+            # Index constants for the contrastive losses, sized by the
+            # runtime batch dimension: under pmap each device only sees its
+            # shard, and indices built from config.batch_size would make the
+            # clamping gather silently re-read the last row.
+            idx = jnp.arange(batch_size)
+            goal_indices = jnp.roll(idx, -1)
             # Note: We might be able to speed up the computation for some of the
             # baselines to making a single network that returns all the values. This
             # avoids computing some of the underlying representations multiple times.
             if config.use_td:
                 # For TD learning, the diagonal elements are the immediate next state.
-                s, g = jnp.split(transitions.observation, [config.obs_dim], axis=1)
-                # next_s, _ = jnp.split(transitions.next_observation, [config.obs_dim],
-                #                       axis=1)
-                next_s, next_g = jnp.split(transitions.next_observation, [config.obs_dim],
-                                           axis=1)
+                # Plain slices instead of jnp.split: the split builds both
+                # halves as fresh arrays even when only one side is consumed.
+                s = transitions.observation[:, :config.obs_dim]
+                g = transitions.observation[:, config.obs_dim:]
+                next_s = transitions.next_observation[:, :config.obs_dim]
+                next_g = transitions.next_observation[:, config.obs_dim:]
                 if config.add_mc_to_td:
                     next_fraction = (1 - config.discount) / ((1 - config.discount) + 1)
                     num_next = int(batch_size * next_fraction)
@@ -153,52 +198,70 @@ class ContrastiveLearner(acme.Learner):
                     new_g = obs_to_goal(next_s)
                 obs = jnp.concatenate([s, new_g], axis=1)
                 transitions = transitions._replace(observation=obs)
-            I = jnp.eye(batch_size)  # pylint: disable=invalid-name
-            logits = networks.q_network.apply(
-                q_params, transitions.observation, transitions.action)
-            if self._trained_learner_state:
-                oracle_logits = networks.q_network.apply(
-                    self._trained_learner_state.q_params,
-                    transitions.observation,
-                    transitions.action)
-
             # TODO (chongyiz): debug next action here!!!!!
             # logits = networks.q_network.apply(
             #     q_params, transitions.next_observation, transitions.extras['next_action'])
+            # All the q_params forward passes share the same parameters, so
+            # stack their (obs, action) pairs into one batch, call the network
+            # once, and read each branch's [B, B, 2] logits off the matching
+            # diagonal block of the stacked output. Disabled branches drop out
+            # of the stack at trace time via the config flags.
+            q_net_obs = [transitions.observation]
+            q_net_act = [transitions.action]
             if config.use_td and config.use_eq_5:
                 # (chongyiz): Note we can only do actual next action to sample next future goals
                 # for equation (5)
                 next_g_obs = jnp.concatenate([s, next_g], axis=1)
-                next_g_logits = networks.q_network.apply(
-                    q_params, next_g_obs, transitions.action)
+                q_net_obs.append(next_g_obs)
+                q_net_act.append(transitions.action)
             if config.negative_action_sampling:
                 dist_params = networks.policy_network.apply(
                     policy_params, transitions.observation)
                 neg_action = networks.sample(dist_params, key)
-                neg_action_logits = networks.q_network.apply(
-                    q_params, transitions.observation, neg_action)
+                q_net_obs.append(transitions.observation)
+                q_net_act.append(neg_action)
+            if len(q_net_obs) > 1:
+                stacked_logits = q_apply_rem(
+                    q_params,
+                    jnp.concatenate(q_net_obs, axis=0),
+                    jnp.concatenate(q_net_act, axis=0))
+
+                def logits_block(i):
+                    rows = slice(i * batch_size, (i + 1) * batch_size)
+                    return stacked_logits[rows, rows]
+
+                logits = logits_block(0)
+                if config.use_td and config.use_eq_5:
+                    next_g_logits = logits_block(1)
+                if config.negative_action_sampling:
+                    neg_action_logits = logits_block(len(q_net_obs) - 1)
+            else:
+                logits = q_apply_rem(
+                    q_params, transitions.observation, transitions.action)
+            if trained_learner_state:
+                # The oracle forward runs on a different (frozen) parameter
+                # tree, so it cannot join the stacked call.
+                oracle_logits = networks.q_network.apply(
+                    trained_learner_state.q_params,
+                    transitions.observation,
+                    transitions.action)
 
             if config.use_td:
-                # Make sure to use the twin Q trick.
-                assert len(logits.shape) == 3
+                # The critic uses the twin Q trick, so logits is [B, B, 2].
 
-                # We evaluate the next-state Q function using random goals
-                # s, g = jnp.split(transitions.observation, [config.obs_dim], axis=1)
-                # del s
-                next_s = transitions.next_observation[:, :config.obs_dim]
-                goal_indices = jnp.roll(jnp.arange(batch_size, dtype=jnp.int32), -1)
+                # We evaluate the next-state Q function using random goals.
+                # next_s was sliced above; transitions.next_observation is
+                # untouched so far, so no re-slice is needed here.
 
                 if config.use_eq_5:
-                    assert len(next_g_logits.shape) == 3
-
-                    pos_logits = jax.vmap(jnp.diag, -1, -1)(logits)
+                    pos_logits = logits[idx, idx]
                     loss_pos1 = optax.sigmoid_binary_cross_entropy(
                         logits=pos_logits, labels=1)  # [B, 2]
-                    next_g_pos_logits = jax.vmap(jnp.diag, -1, -1)(next_g_logits)
+                    next_g_pos_logits = next_g_logits[idx, idx]
                     loss_pos2 = optax.sigmoid_binary_cross_entropy(
                         logits=next_g_pos_logits, labels=1)  # [B, 2]
 
-                    neg_logits = logits[jnp.arange(batch_size), goal_indices]
+                    neg_logits = logits[idx, goal_indices]
                     loss_neg = optax.sigmoid_binary_cross_entropy(
                         logits=neg_logits, labels=0)  # [B, 2]
 
@@ -211,30 +274,55 @@ class ContrastiveLearner(acme.Learner):
                     transitions = transitions._replace(
                         next_observation=jnp.concatenate([next_s, rand_g], axis=1))
                     # TODO (chongyiz): interpolate between C-Learning and SARSA to see what happens
-                    assert 0.0 <= config.c_learning_prob <= 1.0
-                    rand = np.random.uniform()
-                    if (rand > config.c_learning_prob) and config.actual_next_action:
-                        next_action = transitions.extras['next_action']
-                    elif (rand > config.c_learning_prob) and config.fitted_next_action:
-                        next_dist_params = networks.behavioral_cloning_policy_network.apply(
-                            behavioral_cloning_policy_params,
-                            transitions.next_observation[:, :self._obs_dim])
-                        next_action = networks.sample(next_dist_params, key)
-                    elif rand <= config.c_learning_prob:
+                    def c_learning_next_action(key):
                         next_dist_params = networks.policy_network.apply(
                             policy_params, transitions.next_observation)
-                        next_action = networks.sample(next_dist_params, key)
-                    else:
+                        return networks.sample(next_dist_params, key)
+
+                    if config.actual_next_action:
+                        def sarsa_next_action(key):
+                            del key
+                            return transitions.extras['next_action']
+                    elif config.fitted_next_action:
+                        def sarsa_next_action(key):
+                            next_dist_params = networks.behavioral_cloning_policy_network.apply(
+                                behavioral_cloning_policy_params,
+                                transitions.next_observation[:, :self._obs_dim])
+                            return networks.sample(next_dist_params, key)
+                    elif config.c_learning_prob < 1.0:
                         raise NotImplementedError
+                    else:
+                        sarsa_next_action = None
+
                     if config.next_action_add_gaussian_noise:
-                        next_action += jax.random.normal(key, next_action.shape)
-                    next_q = networks.q_network.apply(target_q_params,
-                                                      transitions.next_observation,
-                                                      next_action)  # This outputs logits.
+                        key, key_noise = jax.random.split(key)
+                    key_coin, key_next_action = jax.random.split(key)
+                    if sarsa_next_action is None or config.c_learning_prob == 1.0:
+                        next_action = c_learning_next_action(key_next_action)
+                    elif config.c_learning_prob == 0.0:
+                        next_action = sarsa_next_action(key_next_action)
+                    else:
+                        # Draw the coin inside the graph: a host-side
+                        # np.random.uniform here runs at trace time, freezing
+                        # one branch for the entire run.
+                        rand = jax.random.uniform(key_coin)
+                        next_action = jax.lax.cond(
+                            rand <= config.c_learning_prob,
+                            c_learning_next_action, sarsa_next_action,
+                            key_next_action)
+                    if config.next_action_add_gaussian_noise:
+                        # Use a dedicated key: `key` already seeded the action
+                        # sampling above, so reusing it here correlated the
+                        # noise with the sampled actions.
+                        next_action = next_action + jax.random.normal(
+                            key_noise, next_action.shape, next_action.dtype)
+                    next_q = bf16_q_apply(target_q_params,
+                                          transitions.next_observation,
+                                          next_action)  # This outputs logits.
                     next_q = jax.nn.sigmoid(next_q)
                     next_v = jnp.min(next_q, axis=-1)
                     next_v = jax.lax.stop_gradient(next_v)
-                    next_v = jnp.diag(next_v)
+                    next_v = next_v[idx, idx]
                     # diag(logits) are predictions for future states.
                     # diag(next_q) are predictions for random states, which correspond to
                     # the predictions logits[range(B), goal_indices].
@@ -242,45 +330,50 @@ class ContrastiveLearner(acme.Learner):
                     # diagonal entries are meaningless and shouldn't be used.
                     w_before_clipping = next_v / (1 - next_v)
 
-                    if self._trained_learner_state:
-                        oracle_next_q = networks.q_network.apply(
-                            self._trained_learner_state.target_q_params,
+                    if trained_learner_state:
+                        oracle_next_q = bf16_q_apply(
+                            trained_learner_state.target_q_params,
                             transitions.next_observation,
-                            next_action
-                        )
+                            next_action)
                         oracle_next_v = jax.nn.sigmoid(oracle_next_q)
                         oracle_next_v = jnp.min(oracle_next_v, axis=-1)
-                        oracle_next_v = jnp.diag(oracle_next_v)
+                        oracle_next_v = oracle_next_v[idx, idx]
                         oracle_w_before_clipping = oracle_next_v / (1 - oracle_next_v)
 
                     w_clipping = 20.0
                     # w_clipping = config.w_clipping
                     w = jnp.clip(w_before_clipping, 0, w_clipping)
                     # (B, B, 2) --> (B, 2), computes diagonal of each twin Q.
-                    pos_logits = jax.vmap(jnp.diag, -1, -1)(logits)
-                    if self._trained_learner_state:
-                        oracle_pos_logits = jax.vmap(jnp.diag, -1, -1)(oracle_logits)
-                    loss_pos = optax.sigmoid_binary_cross_entropy(
-                        logits=pos_logits, labels=1)  # [B, 2]
-
-                    neg_logits = logits[jnp.arange(batch_size), goal_indices]
-                    if self._trained_learner_state:
-                        oracle_neg_logits = oracle_logits[jnp.arange(batch_size), goal_indices]
-                    loss_neg1 = w[:, None] * optax.sigmoid_binary_cross_entropy(
-                        logits=neg_logits, labels=1)  # [B, 2]
-                    loss_neg2 = optax.sigmoid_binary_cross_entropy(
-                        logits=neg_logits, labels=0)  # [B, 2]
+                    pos_logits = logits[idx, idx]
+                    if trained_learner_state:
+                        oracle_pos_logits = oracle_logits[idx, idx]
+                    # Sigmoid BCE against labels 1/0 is softplus(-x) /
+                    # softplus(x). Folding the weighted label-1 and label-0
+                    # terms on neg_logits through softplus(-x) = softplus(x)
+                    # - x leaves a single softplus on the negatives instead
+                    # of two generic BCE evaluations.
+                    loss_pos = jax.nn.softplus(-pos_logits)  # [B, 2]
+
+                    neg_logits = logits[idx, goal_indices]
+                    if trained_learner_state:
+                        oracle_neg_logits = oracle_logits[idx, goal_indices]
+                    wd = config.discount * w[:, None]
+                    label0_weight = 2.0 if config.add_mc_to_td else 1.0
+                    loss_neg = ((wd + label0_weight)
+                                * jax.nn.softplus(neg_logits)
+                                - wd * neg_logits)  # [B, 2]
 
                     if config.add_mc_to_td:
-                        loss = ((1 + (1 - config.discount)) * loss_pos
-                                + config.discount * loss_neg1 + 2 * loss_neg2)
+                        loss = (1 + (1 - config.discount)) * loss_pos + loss_neg
                     else:
-                        loss = ((1 - config.discount) * loss_pos
-                                + config.discount * loss_neg1 + loss_neg2)
+                        loss = (1 - config.discount) * loss_pos + loss_neg
                 # Take the mean here so that we can compute the accuracy.
                 logits = jnp.mean(logits, axis=-1)
 
             else:  # For the MC losses.
+                # Only the MC losses still need the explicit identity labels.
+                I = jnp.eye(batch_size)  # pylint: disable=invalid-name
+
                 def loss_fn(_logits):  # pylint: disable=invalid-name
                     if config.use_cpc:
                         return (optax.softmax_cross_entropy(logits=_logits, labels=I)
@@ -291,14 +384,13 @@ class ContrastiveLearner(acme.Learner):
                 if len(logits.shape) == 3:  # twin q
                     # loss.shape = [.., num_q]
                     if config.negative_action_sampling:
-                        pos_logits = jax.vmap(jnp.diag, -1, -1)(logits)
+                        pos_logits = logits[idx, idx]
                         pos_loss = optax.sigmoid_binary_cross_entropy(
                             logits=pos_logits, labels=1)  # [B, 2]
                         if config.negative_action_sampling_future_goals:
-                            neg_logits = jax.vmap(jnp.diag, -1, -1)(neg_action_logits)
+                            neg_logits = neg_action_logits[idx, idx]
                         else:
-                            rnd_goal_indices = jnp.roll(jnp.arange(batch_size, dtype=jnp.int32), -1)
-                            neg_logits = neg_action_logits[jnp.arange(batch_size), rnd_goal_indices]
+                            neg_logits = neg_action_logits[idx, goal_indices]
                         neg_loss = optax.sigmoid_binary_cross_entropy(
                             logits=neg_logits, labels=0)
                         # TODO (chongyiz): Can we simply sum the pos_loss and neg_loss here?
@@ -314,11 +406,23 @@ class ContrastiveLearner(acme.Learner):
                     loss = loss_fn(logits)
 
             loss = jnp.mean(loss)
-            correct = (jnp.argmax(logits, axis=1) == jnp.argmax(I, axis=1))
-            logits_pos = jnp.sum(logits * I) / jnp.sum(I)
-            logits_neg = jnp.sum(logits * (1 - I)) / jnp.sum(1 - I)
-            q_pos, q_neg = jnp.sum(jax.nn.sigmoid(logits) * I) / jnp.sum(I), \
-                           jnp.sum(jax.nn.sigmoid(logits) * (1 - I)) / jnp.sum(1 - I)
+
+            def diag_and_off_diag_means(matrix):
+                """Means of the diagonal / off-diagonal without an eye mask.
+
+                The diagonal is averaged directly and the off-diagonal mean is
+                the total minus the diagonal, so no B x B identity is
+                materialized and no masked multiplies run.
+                """
+                diag = matrix[idx, idx]
+                diag_mean = jnp.mean(diag)
+                off_diag_mean = ((jnp.sum(matrix) - jnp.sum(diag))
+                                 / (batch_size * (batch_size - 1)))
+                return diag, diag_mean, off_diag_mean
+
+            correct = (jnp.argmax(logits, axis=1) == idx)
+            diag_logits, logits_pos, logits_neg = diag_and_off_diag_means(logits)
+            _, q_pos, q_neg = diag_and_off_diag_means(jax.nn.sigmoid(logits))
             q_pos_ratio, q_neg_ratio = q_pos / (1 - q_pos), q_neg / (1 - q_neg)
             # TODO (chongyiz): The magnitude between q_pos_ratio and q_neg_ratio are unbalanced now!
             # q_ratio = (q_pos_ratio + q_neg_ratio) / 2
@@ -326,8 +430,13 @@ class ContrastiveLearner(acme.Learner):
                 logsumexp = jax.nn.logsumexp(logits[:, :, 0], axis=1) ** 2
             else:
                 logsumexp = jax.nn.logsumexp(logits, axis=1) ** 2
+            # Sign agreement with the identity labels: diagonal entries should
+            # be positive, off-diagonal entries non-positive.
+            binary_accuracy = (2 * jnp.sum(diag_logits > 0)
+                               + batch_size * (batch_size - 1)
+                               - jnp.sum(logits > 0)) / (batch_size ** 2)
             metrics = {
-                'binary_accuracy': jnp.mean((logits > 0) == I),
+                'binary_accuracy': binary_accuracy,
                 'categorical_accuracy': jnp.mean(correct),
                 'logits_pos': logits_pos,
                 'logits_neg': logits_neg,
@@ -337,13 +446,12 @@ class ContrastiveLearner(acme.Learner):
                 # 'q_ratio': q_ratio,
             }
 
-            if self._use_td and self._trained_learner_state:
+            if self._use_td and trained_learner_state:
                 oracle_logits = jnp.mean(oracle_logits, axis=-1)
-                oracle_logits_pos = jnp.sum(oracle_logits * I) / jnp.sum(I)
-                oracle_logits_neg = jnp.sum(oracle_logits * (1 - I)) / jnp.sum(1 - I)
-                oracle_q_pos, oracle_q_neg = \
-                    jnp.sum(jax.nn.sigmoid(oracle_logits) * I) / jnp.sum(I), \
-                    jnp.sum(jax.nn.sigmoid(oracle_logits) * (1 - I)) / jnp.sum(1 - I)
+                _, oracle_logits_pos, oracle_logits_neg = (
+                    diag_and_off_diag_means(oracle_logits))
+                _, oracle_q_pos, oracle_q_neg = (
+                    diag_and_off_diag_means(jax.nn.sigmoid(oracle_logits)))
                 oracle_q_pos_ratio, oracle_q_neg_ratio = \
                     oracle_q_pos / (1 - oracle_q_pos), \
                     oracle_q_neg / (1 - oracle_q_neg)
@@ -374,7 +482,7 @@ class ContrastiveLearner(acme.Learner):
         def actor_loss(policy_params: networks_lib.Params,
                        q_params: networks_lib.Params,
                        target_q_params: networks_lib.Params,
-                       behavioral_cloning_policy_params: networks_lib.Params,
+                       bc_dist_params,
                        alpha: jnp.ndarray,
                        transitions: types.Transition,
                        key: networks_lib.PRNGKey,
@@ -395,8 +503,7 @@ class ContrastiveLearner(acme.Learner):
                 elif config.random_goals == 0.5:
                     new_state = jnp.concatenate([state, state], axis=0)
                     new_goal = jnp.concatenate([goal, jnp.roll(goal, 1, axis=0)], axis=0)
-                else:
-                    assert config.random_goals == 1.0
+                else:  # config.random_goals == 1.0, validated in __init__.
                     new_state = state
                     new_goal = jnp.roll(goal, 1, axis=0)
 
@@ -406,31 +513,54 @@ class ContrastiveLearner(acme.Learner):
                 action = networks.sample(dist_params, key)
                 log_prob = networks.log_prob(dist_params, action)
                 if config.actor_loss_with_target_critic:
-                    q_action = networks.q_network.apply(
-                        target_q_params, new_obs, action)
+                    critic_params = target_q_params
                 else:
-                    q_action = networks.q_network.apply(
-                        q_params, new_obs, action)
-                if len(q_action.shape) == 3:  # twin q trick
-                    assert q_action.shape[2] == 2
-                    q_action = jnp.min(q_action, axis=-1)
+                    critic_params = q_params
+
+                def diag_q(obs_half, action_half):
+                    q = networks.q_network.apply(
+                        critic_params, obs_half, action_half)
+                    if len(q.shape) == 3:  # twin q trick
+                        q = jnp.min(q, axis=-1)
+                    return jnp.diagonal(q)
+
+                if config.random_goals == 0.5:
+                    # Only the diagonal of the pairwise critic output is
+                    # consumed, so score the two relabelled halves with
+                    # separate B-row applies: the tower forwards still cover
+                    # 2B rows once, but the pairwise outer product shrinks
+                    # from (2B)^2 to 2 * B^2 entries.
+                    half = new_obs.shape[0] // 2
+                    q_action_diag = jnp.concatenate(
+                        [diag_q(new_obs[:half], action[:half]),
+                         diag_q(new_obs[half:], action[half:])], axis=0)
+                else:
+                    q_action_diag = diag_q(new_obs, action)
                 # TODO (chongyiz): implement reverse KL
                 if config.actor_loss_with_reverse_kl:
-                    actor_loss = -jnp.diag(q_action)
-                    assert 0.0 <= config.reverse_kl_coef <= 1.0
+                    actor_loss = -q_action_diag
                     if config.reverse_kl_coef > 0:
-                        behavioral_cloning_dist_params = \
-                            networks.behavioral_cloning_policy_network.apply(
-                                behavioral_cloning_policy_params,
-                                new_obs[:, :self._obs_dim])
-                        log_beta_prob = networks.log_prob(
-                            behavioral_cloning_dist_params, action)
+                        # The state half of new_obs is the original batch (or
+                        # two copies of it under 50% goal relabelling), so the
+                        # shared BC forward from update_step covers it; the
+                        # doubled action batch is scored in halves against the
+                        # B-row distribution.
+                        if config.random_goals == 0.5:
+                            half = action.shape[0] // 2
+                            log_beta_prob = jnp.concatenate([
+                                networks.log_prob(bc_dist_params,
+                                                  action[:half]),
+                                networks.log_prob(bc_dist_params,
+                                                  action[half:]),
+                            ], axis=0)
+                        else:
+                            log_beta_prob = networks.log_prob(
+                                bc_dist_params, action)
                         reverse_kl_loss = log_prob - log_beta_prob
                         actor_loss = config.reverse_kl_coef * reverse_kl_loss + \
                                      (1 - config.reverse_kl_coef) * actor_loss
                 else:
-                    actor_loss = alpha * log_prob - jnp.diag(q_action)
-                    assert 0.0 <= config.bc_coef <= 1.0
+                    actor_loss = alpha * log_prob - q_action_diag
                     if config.bc_coef > 0:
                         orig_action = transitions.action
                         if config.random_goals == 0.5:
@@ -441,10 +571,64 @@ class ContrastiveLearner(acme.Learner):
 
             return jnp.mean(actor_loss)
 
-        alpha_grad = jax.value_and_grad(alpha_loss)
-        critic_grad = jax.value_and_grad(critic_loss, has_aux=True)
-        actor_grad = jax.value_and_grad(actor_loss)
-        behavioral_cloning_grad = jax.value_and_grad(behavioral_cloning_loss)
+        def joint_loss(policy_params: networks_lib.Params,
+                       q_params: networks_lib.Params,
+                       behavioral_cloning_policy_params: networks_lib.Params,
+                       log_alpha: jnp.ndarray,
+                       target_q_params: networks_lib.Params,
+                       bc_dist_params,
+                       transitions: types.Transition,
+                       key_alpha: networks_lib.PRNGKey,
+                       key_critic: networks_lib.PRNGKey,
+                       key_actor: networks_lib.PRNGKey,
+                       key_behavioral_cloning: networks_lib.PRNGKey):
+            """Sums the four losses so one value_and_grad covers them.
+
+            Each term only differentiates its own parameter tree; the
+            cross-term parameters are stop_gradient'ed, so the summed
+            gradients match the four separate gradient calls while XLA sees
+            one graph and can share the common forwards and activations.
+            """
+            frozen_policy_params = jax.lax.stop_gradient(policy_params)
+            frozen_q_params = jax.lax.stop_gradient(q_params)
+            frozen_bc_params = jax.lax.stop_gradient(
+                behavioral_cloning_policy_params)
+
+            if adaptive_entropy_coefficient:
+                # One exp of log_alpha serves the alpha loss (with gradient)
+                # and, detached, the actor's entropy weight.
+                alpha = jnp.exp(log_alpha)
+                alpha_loss_ = alpha_loss(alpha, frozen_policy_params,
+                                         bc_dist_params, transitions,
+                                         key_alpha)
+                alpha = jax.lax.stop_gradient(alpha)
+            else:
+                alpha_loss_ = 0.0
+                alpha = config.entropy_coefficient
+
+            if config.use_gcbc:
+                critic_loss_ = 0.0
+                critic_metrics = {}
+            else:
+                critic_loss_, critic_metrics = critic_loss(
+                    q_params, frozen_policy_params, target_q_params,
+                    frozen_bc_params, transitions, key_critic)
+
+            actor_loss_ = actor_loss(policy_params, frozen_q_params,
+                                     target_q_params, bc_dist_params, alpha,
+                                     transitions, key_actor)
+
+            behavioral_cloning_loss_ = behavioral_cloning_loss(
+                behavioral_cloning_policy_params, transitions,
+                key_behavioral_cloning)
+
+            loss = (critic_loss_ + actor_loss_ + alpha_loss_
+                    + behavioral_cloning_loss_)
+            return loss, (critic_loss_, actor_loss_, alpha_loss_,
+                          behavioral_cloning_loss_, critic_metrics)
+
+        joint_grad = jax.value_and_grad(joint_loss, argnums=(0, 1, 2, 3),
+                                        has_aux=True)
 
         def update_step(
                 state: TrainingState,
@@ -454,28 +638,35 @@ class ContrastiveLearner(acme.Learner):
             key, key_alpha, key_critic, key_actor, key_behavioral_cloning = \
                 jax.random.split(state.key, 5)
             # key, key_alpha, key_critic, key_actor = jax.random.split(state.key, 4)
+            # The BC forward on the state half of the batch is shared by the
+            # alpha and actor reverse-KL terms; behavioral_cloning_loss
+            # recomputes it because it differentiates the BC parameters.
+            if config.actor_loss_with_reverse_kl:
+                bc_dist_params = networks.behavioral_cloning_policy_network.apply(
+                    state.behavioral_cloning_policy_params,
+                    transitions.observation[:, :self._obs_dim])
+            else:
+                bc_dist_params = None
             if adaptive_entropy_coefficient:
-                alpha_loss, alpha_grads = alpha_grad(state.alpha_params,
-                                                     state.policy_params,
-                                                     state.behavioral_cloning_policy_params,
-                                                     transitions,
-                                                     key_alpha)
-                alpha = jnp.exp(state.alpha_params)
+                log_alpha = state.alpha_params
             else:
-                alpha = config.entropy_coefficient
-
-            if not config.use_gcbc:
-                (critic_loss, critic_metrics), critic_grads = critic_grad(
-                    state.q_params, state.policy_params, state.target_q_params,
-                    state.behavioral_cloning_policy_params, transitions, key_critic)
-
-            actor_loss, actor_grads = actor_grad(state.policy_params, state.q_params,
-                                                 state.target_q_params,
-                                                 state.behavioral_cloning_policy_params,
-                                                 alpha, transitions, key_actor)
-
-            behavioral_cloning_loss, behavioral_cloning_grads = behavioral_cloning_grad(
-                state.behavioral_cloning_policy_params, transitions, key_behavioral_cloning)
+                # Unused placeholder; its gradient is discarded.
+                log_alpha = jnp.zeros(())
+
+            (_, (critic_loss, actor_loss, alpha_loss, behavioral_cloning_loss,
+                 critic_metrics)), grads = joint_grad(
+                state.policy_params, state.q_params,
+                state.behavioral_cloning_policy_params, log_alpha,
+                state.target_q_params, bc_dist_params, transitions,
+                key_alpha, key_critic, key_actor, key_behavioral_cloning)
+            (actor_grads, critic_grads, behavioral_cloning_grads,
+             alpha_grads) = grads
+            if use_pmap:
+                # Each device computed gradients on its own batch shard;
+                # average them so every replica applies the same update.
+                grads = jax.lax.pmean(grads, axis_name='i')
+                (actor_grads, critic_grads, behavioral_cloning_grads,
+                 alpha_grads) = grads
 
             # Apply policy gradients
             actor_update, policy_optimizer_state = policy_optimizer.update(
@@ -485,7 +676,6 @@ class ContrastiveLearner(acme.Learner):
             # Apply critic gradients
             if config.use_gcbc:
                 metrics = {}
-                critic_loss = 0.0
                 q_params = state.q_params
                 q_optimizer_state = state.q_optimizer_state
                 new_target_q_params = state.target_q_params
@@ -495,9 +685,8 @@ class ContrastiveLearner(acme.Learner):
 
                 q_params = optax.apply_updates(state.q_params, critic_update)
 
-                new_target_q_params = jax.tree_multimap(
-                    lambda x, y: x * (1 - config.tau) + y * config.tau,
-                    state.target_q_params, q_params)
+                new_target_q_params = optax.incremental_update(
+                    q_params, state.target_q_params, config.tau)
                 metrics = critic_metrics
 
             # (chongyiz): Apply behavioral cloning gradients
@@ -548,16 +737,45 @@ class ContrastiveLearner(acme.Learner):
             'learner', asynchronous=True, serialize_fn=utils.fetch_devicearray,
             time_delta=10.0)
 
-        # Iterator on demonstration transitions.
-        self._iterator = iterator
-
-        update_step = utils.process_multiple_batches(update_step,
-                                                     config.num_sgd_steps_per_step)
-        # Use the JIT compiler.
-        if config.jit:
-            self._update_step = jax.jit(update_step)
+        # Iterator on demonstration transitions. Prefetch on a background
+        # thread so the reverb sample conversion and the host-to-device copy
+        # of the next batch overlap with the current update step.
+        def transition_iterator(it):
+            while True:
+                yield types.Transition(*next(it).data)
+
+        # utils.prefetch only copies to device when one is given; without it
+        # the buffering is host-side only. On the pmap path the batch is
+        # sharded across devices in step(), so leave it on host there.
+        self._iterator = utils.prefetch(
+            transition_iterator(iterator), buffer_size=2,
+            device=None if use_pmap else jax.local_devices()[0])
+
+        def update_steps(state, transitions):
+            """Runs num_sgd_steps_per_step updates under a single lax.scan.
+
+            The scan compiles one loop body instead of unrolling
+            num_sgd_steps_per_step copies of update_step into the HLO.
+            """
+            batches = jax.tree_map(
+                lambda x: x.reshape(
+                    (config.num_sgd_steps_per_step, -1) + x.shape[1:]),
+                transitions)
+            state, metrics = jax.lax.scan(update_step, state, batches)
+            return state, jax.tree_map(jnp.mean, metrics)
+
+        # Use the JIT compiler. Donating the state lets XLA reuse the input
+        # parameter and optimizer-state buffers for the outputs instead of
+        # keeping both trees live across the step. With more than one local
+        # device the step is pmapped: each device consumes its own shard of
+        # the batch and the gradients are pmean'd above.
+        if use_pmap:
+            self._update_step = jax.pmap(update_steps, axis_name='i',
+                                         donate_argnums=(0,))
+        elif config.jit:
+            self._update_step = jax.jit(update_steps, donate_argnums=(0,))
         else:
-            self._update_step = update_step
+            self._update_step = update_steps
 
         def make_initial_state(key: networks_lib.PRNGKey) -> TrainingState:
             """Initialises the training state (parameters and optimiser state)."""
@@ -593,39 +811,44 @@ class ContrastiveLearner(acme.Learner):
 
         # Create initial state.
         self._state = make_initial_state(rng)
+        if use_pmap:
+            self._state = jax.device_put_replicated(self._state,
+                                                    jax.local_devices())
 
         # Do not record timestamps until after the first learning step is done.
         # This is to avoid including the time it takes for actors to come online
         # and fill the replay buffer.
         self._timestamp = None
 
-        # # (chongyiz): load the trained agent here.
+        # # (chongyiz): load the trained agent here. Restore straight into a
+        # # TrainingState instead of deep-copying the whole learner: deepcopy
+        # # walks every pytree leaf (parameters, optimizer state, callables)
+        # # and duplicates the host buffers, doubling peak host memory just
+        # # to read a checkpoint.
         # if config.trained_agent_dir is not None:
-        #     trained_learner = copy.deepcopy(self)
+        #     holder = {'state': self._state}
         #     ckpt = savers.Checkpointer(
-        #         object_to_save={'learner': trained_learner},
+        #         object_to_save=holder,
         #         directory=config.trained_agent_dir,
         #         subdirectory='learner',
         #         add_uid=False,
         #     )
         #     ckpt.restore()
-        #
-        #     q0 = self._state.q_params.copy()
-        #     q1 = trained_learner._state.q_params.copy()
-        #
-        #     for k, v in q0.items():
-        #         for k_, v_ in v.items():
-        #             assert (q0[k][k_] - q1[k][k_]).sum() != 0, f'New parameters are the same as old {k}.{k_}'
-        #             print(f'{k}.{k_} parameters successfully updated!')
-        #
-        # print()
-        # print()
+        #     self._state = self._state._replace(
+        #         q_params=holder['state'].q_params)
 
     def step(self):
         with jax.profiler.StepTraceAnnotation('step', step_num=self._counter):
-            sample = next(self._iterator)
-            transitions = types.Transition(*sample.data)
+            transitions = next(self._iterator)
+            if self._use_pmap:
+                # Shard the batch across devices: [B, ...] ->
+                # [num_devices, B / num_devices, ...].
+                transitions = jax.tree_map(
+                    lambda x: x.reshape((self._num_devices, -1) + x.shape[1:]),
+                    transitions)
             self._state, metrics = self._update_step(self._state, transitions)
+            if self._use_pmap:
+                metrics = utils.get_from_first_device(metrics)
 
         # Compute elapsed time.
         timestamp = time.time()
@@ -644,14 +867,24 @@ class ContrastiveLearner(acme.Learner):
         self._logger.write({**metrics, **counts})
 
     def get_variables(self, names: List[str]) -> List[Any]:
+        state = self._state
+        if self._use_pmap:
+            state = utils.get_from_first_device(state)
         variables = {
-            'policy': self._state.policy_params,
-            'critic': self._state.q_params,
+            'policy': state.policy_params,
+            'critic': state.q_params,
         }
         return [variables[name] for name in names]
 
     def save(self) -> TrainingState:
-        return self._state
+        state = self._state
+        if self._use_pmap:
+            # Checkpoint an unreplicated copy so the saved state does not
+            # bake this host's device count into every leaf.
+            state = utils.get_from_first_device(state)
+        return state
 
     def restore(self, state: TrainingState):
+        if self._use_pmap:
+            state = jax.device_put_replicated(state, jax.local_devices())
         self._state = state
@@ -50,8 +50,14 @@ class RelaxedOnehotCategoricalHead(networks_lib.CategoricalHead):
 
 def apply_policy_and_sample(
         networks,
-        eval_mode=False):
-    """Returns a function that computes actions."""
+        eval_mode=False,
+        batched=False):
+    """Returns a function that computes actions.
+
+    With batched=True the returned function maps over stacked
+    [num_envs, ...] observations with one key per env (e.g. from a
+    vectorized env), amortizing the single dispatch across all envs.
+    """
     sample_fn = networks.sample if not eval_mode else networks.sample_eval
     if not sample_fn:
         raise ValueError('sample function is not provided')
@@ -59,7 +65,13 @@ def apply_policy_and_sample(
     def apply_and_sample(params, key, obs):
         return sample_fn(networks.policy_network.apply(params, obs), key)
 
-    return apply_and_sample
+    if batched:
+        apply_and_sample = jax.vmap(apply_and_sample, in_axes=(None, 0, 0))
+    # Jit here so the policy forward and the sampling run as one compiled
+    # call per actor step instead of Python dispatching two XLA calls.
+    # Actors build this closure once and hold on to it, so the jit trace
+    # cache stays warm without any extra keying.
+    return jax.jit(apply_and_sample)
 
 
 def make_networks(
@@ -78,12 +90,18 @@ def make_networks(
     TORSO = networks_lib.AtariTorso  # pylint: disable=invalid-name
 
     def _unflatten_obs(obs):
-        state = jnp.reshape(obs[:, :obs_dim], (-1, 64, 64, 3)) / 255.0
-        goal = jnp.reshape(obs[:, obs_dim:], (-1, 64, 64, 3)) / 255.0
+        # Cast then multiply by the reciprocal: this accepts uint8 pixels
+        # straight from replay (4x fewer bytes into the graph than float32)
+        # and XLA fuses the scale into the first conv.
+        state = jnp.reshape(obs[:, :obs_dim], (-1, 64, 64, 3)).astype(
+            jnp.float32) * (1.0 / 255.0)
+        goal = jnp.reshape(obs[:, obs_dim:], (-1, 64, 64, 3)).astype(
+            jnp.float32) * (1.0 / 255.0)
         return state, goal
 
     def _unflatten_img(img):
-        img = jnp.reshape(img, (-1, 64, 64, 3)) / 255.0
+        img = jnp.reshape(img, (-1, 64, 64, 3)).astype(
+            jnp.float32) * (1.0 / 255.0)
         return img
 
     # def _repr_fn(obs, action, hidden=None):
@@ -208,110 +226,116 @@ def make_networks(
     #     return sa_repr, g_repr, fs_repr, (state, goal, future_state)
     #     # return sag_repr, fs_repr, (state, goal, future_state)
 
+    # Static layer sizes and the Cayley identity depend only on constructor
+    # arguments, so build them once here instead of on every trace of
+    # _repr_fn. The numpy eye gets lifted into a single HLO constant rather
+    # than being re-emitted per trace.
+    sa_sizes = list(hidden_layer_sizes) + [repr_dim]
+    g_sizes = list(hidden_layer_sizes) + [repr_dim * repr_dim]
+    I = np.eye(repr_dim, dtype=np.float32)  # pylint: disable=invalid-name
+
+    def _stacked_init(base_init):
+        """Initializes each twin slice with fans from its own 2D shape."""
+        def init(shape, dtype):
+            return jnp.stack(
+                [base_init(shape[1:], dtype) for _ in range(shape[0])])
+        return init
+
+    def _twin_mlp(name, output_sizes, x):
+        """Runs two independent MLP twins as one stack of batched matmuls.
+
+        The per-twin weights are stacked on a leading axis, so every layer
+        is a single [2, B, in] @ [2, in, out] grouped GEMM — one launch per
+        layer, like a fused MLP — while the twins stay fully independent
+        networks with no shared hidden layers.
+        """
+        w_init = _stacked_init(
+            hk.initializers.VarianceScaling(1.0, 'fan_in', 'uniform'))
+        h = jnp.broadcast_to(x, (2,) + x.shape)
+        sizes = (x.shape[-1],) + tuple(output_sizes)
+        for i in range(len(output_sizes)):
+            w = hk.get_parameter('{}_linear_{}_w'.format(name, i),
+                                 [2, sizes[i], sizes[i + 1]], x.dtype,
+                                 init=w_init)
+            b = hk.get_parameter('{}_linear_{}_b'.format(name, i),
+                                 [2, sizes[i + 1]], x.dtype, init=jnp.zeros)
+            h = jnp.einsum('tbi,tio->tbo', h, w) + b[:, None, :]
+            if i + 1 < len(output_sizes):
+                h = jax.nn.relu(h)
+        return h  # [2, B, output_sizes[-1]]
+
     def _repr_fn(obs, action, goal, future_obs):
         # The optional input hidden is the image representations. We include this
         # as an input for the second Q value when twin_q = True, so that the two Q
         # values use the same underlying image representation.
         if use_image_obs:
-            obs = _unflatten_img(obs)
-            goal = _unflatten_img(goal)
-            future_obs = _unflatten_img(future_obs)
+            # The three image batches share the torso weights, so encode
+            # them in one conv forward over the concatenated batch instead
+            # of three smaller launches. Split at each input's own batch
+            # size rather than in equal thirds: the future_obs batch can be
+            # larger than the others (e.g. 2B future states scored against
+            # B observations and goals).
+            imgs = [_unflatten_img(obs), _unflatten_img(goal),
+                    _unflatten_img(future_obs)]
             img_encoder = TORSO()
-            state = img_encoder(obs)
-            goal = img_encoder(goal)
-            future_state = img_encoder(future_obs)
+            state, goal, future_state = jnp.split(
+                img_encoder(jnp.concatenate(imgs, axis=0)),
+                np.cumsum([img.shape[0] for img in imgs[:-1]]), axis=0)
         else:
             state = obs
             goal = goal
             future_state = future_obs
 
-        sa_encoder = hk.Sequential([
-            hk.nets.MLP(
-                list(hidden_layer_sizes) + [repr_dim],
-                w_init=hk.initializers.VarianceScaling(1.0, 'fan_in', 'uniform'),
-                activation=jax.nn.relu,
-                name='sa_encoder'),
-        ])
-        sa_repr = sa_encoder(jnp.concatenate([state, action, goal], axis=-1))
-        # sa_repr = sa_encoder(jnp.concatenate([state, action], axis=-1))
-
-        sa_encoder2 = hk.Sequential([
-            hk.nets.MLP(
-                list(hidden_layer_sizes) + [repr_dim],
-                w_init=hk.initializers.VarianceScaling(1.0, 'fan_in', 'uniform'),
-                activation=jax.nn.relu,
-                name='sa_encoder2'),
-        ])
-        sa_repr2 = sa_encoder2(jnp.concatenate([state, action, goal], axis=-1))
-        # sa_repr2 = sa_encoder2(jnp.concatenate([state, action], axis=-1))
-        sa_repr = jnp.stack([sa_repr, sa_repr2], axis=-1)
-
-        g_encoder = hk.Sequential([
-            hk.nets.MLP(
-                list(hidden_layer_sizes) + [repr_dim * repr_dim],
-                w_init=hk.initializers.VarianceScaling(1.0, 'fan_in', 'uniform'),
-                activation=jax.nn.relu,
-                name='g_encoder'),
-        ])
-        g_repr = g_encoder(goal).reshape([-1, repr_dim, repr_dim])  # only upper off-diagonal parameters are used
-        g_repr = jnp.triu(g_repr, k=1)
+        # Each head runs two independent twin MLPs via _twin_mlp: stacked
+        # per-twin weights make every layer one grouped matmul launch while
+        # keeping the two networks fully decorrelated.
+        # Materialize the state-action-goal input once, above the encoders.
+        sag_in = jnp.concatenate([state, action, goal], axis=-1)
+        # sag_in = jnp.concatenate([state, action], axis=-1)
+
+        sa_repr = _twin_mlp('sa_encoder', sa_sizes, sag_in)
+        sa_repr = jnp.moveaxis(sa_repr, 0, -1)  # [B, repr_dim, 2]
+
+        # Twin axis stays in front of the matrix dims so the transpose and
+        # solve below treat [B, 2] as one batch of matrices.
+        g_repr = _twin_mlp('g_encoder', g_sizes, goal)
+        g_repr = jnp.swapaxes(g_repr, 0, 1).reshape(
+            [-1, 2, repr_dim, repr_dim]
+        )  # only the off-diagonal differences are used
         # https://pytorch.org/tutorials/intermediate/parametrizations.html#introduction-to-parametrizations
         # https://math.stackexchange.com/questions/2369940/parametric-representation-of-orthogonal-matrices
-        g_repr = g_repr - g_repr.transpose([0, 2, 1])
-        # checkify.check(jnp.all(g_repr.transpose([0, 2, 1]) == -g_repr),
+        # A - A^T is skew-symmetric for any A, so the jnp.triu prefilter that
+        # used to precede this subtract only remapped which raw entries
+        # parameterize the matrix; dropping it saves a full read+write over
+        # the [B, 2, R, R] tensor and leaves one fusible transpose-subtract.
+        g_repr = g_repr - g_repr.transpose([0, 1, 3, 2])
+        # checkify.check(jnp.all(g_repr.transpose([0, 1, 3, 2]) == -g_repr),
         #                "g_repr must be a skew-symmetric matrix!")
         # q1 = jnp.exp(g_repr)
         # assert jnp.all(q1.transpose([0, 2, 1]) == jnp.linalg.inv(q1))
 
         # Cayley’s parameterization of orthogonal matrices
         # https://en.wikipedia.org/wiki/Cayley_transform
-        I = jnp.eye(repr_dim)[None]
-        g_repr = (I - g_repr) @ jnp.linalg.inv((I + g_repr))
+        # (I - A) and (I + A)^-1 are rational functions of the same matrix,
+        # so they commute: the right division (I - A) @ inv(I + A) equals
+        # solve(I + A, I - A), which is one LU solve instead of a full
+        # inverse followed by a matmul.
+        # Collapse the [B, 2] matrix batch into a single leading dim:
+        # cuSOLVER's batched LU interface consumes one flat batch, so this
+        # runs as one launch over 2B matrices rather than a nested
+        # broadcast.
+        lhs = (I + g_repr).reshape([-1, repr_dim, repr_dim])
+        rhs = (I - g_repr).reshape([-1, repr_dim, repr_dim])
+        g_repr = jnp.linalg.solve(lhs, rhs).reshape(
+            [-1, 2, repr_dim, repr_dim])
         # assert jnp.all(q2.transpose([0, 2, 1]) @ q2 == I)
-        # checkify.check(jnp.allclose(g_repr.transpose([0, 2, 1]) @ g_repr, I, atol=1e-6),
+        # checkify.check(jnp.allclose(g_repr.transpose([0, 1, 3, 2]) @ g_repr, I, atol=1e-6),
         #                "g_repr must be an orthogonal matrix!")
 
-        g_encoder2 = hk.Sequential([
-            hk.nets.MLP(
-                list(hidden_layer_sizes) + [repr_dim * repr_dim],
-                w_init=hk.initializers.VarianceScaling(1.0, 'fan_in', 'uniform'),
-                activation=jax.nn.relu,
-                name='g_encoder2'),
-        ])
-        g_repr2 = g_encoder2(goal).reshape([-1, repr_dim, repr_dim])  # only upper off-diagonal parameters are used
-        g_repr2 = jnp.triu(g_repr2, k=1)
-        g_repr2 = g_repr2 - g_repr2.transpose([0, 2, 1])
-        # assert jnp.all(g_repr.transpose([0, 2, 1]) == -g_repr)
-        # checkify.check(jnp.all(g_repr2.transpose([0, 2, 1]) == -g_repr2),
-        #                "g_repr2 must be a skew-symmetric matrix!")
-        # g_repr2 = jnp.exp(g_repr2)
-
-        g_repr2 = (I - g_repr2) @ jnp.linalg.inv((I + g_repr2))
-        # assert jnp.all(q2.transpose([0, 2, 1]) @ q2 == I)
-        # checkify.check(jnp.allclose(g_repr2.transpose([0, 2, 1]) @ g_repr2, I, atol=1e-6),
-        #                "g_repr2 must be an orthogonal matrix!")
-
-        g_repr = jnp.stack([g_repr, g_repr2], axis=-1)
-        # g_repr = None
+        g_repr = jnp.moveaxis(g_repr, 1, -1)
 
-        fs_encoder = hk.Sequential([
-            hk.nets.MLP(
-                list(hidden_layer_sizes) + [repr_dim],
-                w_init=hk.initializers.VarianceScaling(1.0, 'fan_in', 'uniform'),
-                activation=jax.nn.relu,
-                name='fs_encoder'),
-        ])
-        fs_repr = fs_encoder(future_state)
-
-        fs_encoder2 = hk.Sequential([
-            hk.nets.MLP(
-                list(hidden_layer_sizes) + [repr_dim],
-                w_init=hk.initializers.VarianceScaling(1.0, 'fan_in', 'uniform'),
-                activation=jax.nn.relu,
-                name='fs_encoder2'),
-        ])
-        fs_repr2 = fs_encoder2(future_state)
-        fs_repr = jnp.stack([fs_repr, fs_repr2], axis=-1)
+        fs_repr = _twin_mlp('fs_encoder', sa_sizes, future_state)
+        fs_repr = jnp.moveaxis(fs_repr, 0, -1)  # [B, repr_dim, 2]
 
         # sag_encoder = hk.nets.MLP(
         #     list(hidden_layer_sizes) + [repr_dim],
@@ -335,8 +359,13 @@ def make_networks(
         # logits = logit_encoder(jnp.concatenate([state, action, goal, future_state], axis=-1))
 
         if repr_norm:
-            sa_repr = sa_repr / (jnp.linalg.norm(sa_repr, axis=1, keepdims=True) + 1e-8)
-            fs_repr = fs_repr / (jnp.linalg.norm(fs_repr, axis=1, keepdims=True) + 1e-8)
+            # L2-normalize with a fused rsqrt + multiply instead of norm
+            # (sqrt) followed by a divide; 1e-16 matches the old 1e-8
+            # epsilon on the norm.
+            sa_sq = jnp.sum(sa_repr * sa_repr, axis=1, keepdims=True)
+            sa_repr = sa_repr * jax.lax.rsqrt(sa_sq + 1e-16)
+            fs_sq = jnp.sum(fs_repr * fs_repr, axis=1, keepdims=True)
+            fs_repr = fs_repr * jax.lax.rsqrt(fs_sq + 1e-16)
 
             # if repr_norm_temp:
             #     log_scale = hk.get_parameter('repr_log_scale', [], dtype=sa_repr.dtype,
@@ -375,7 +404,16 @@ def make_networks(
         # return jnp.einsum('ik,jk->ij', sag_repr, fs_repr)
         # return jnp.einsum('ik,jk->ij', sag_repr, fs_repr)
         # return jnp.einsum('ikl,jkl->ijl', sag_repr, fs_repr)
-        return jnp.einsum('ikl,jkl->ijl', sa_repr, fs_repr)
+        # Batched-GEMM form of jnp.einsum('ikl,jkl->ijl', sa_repr, fs_repr):
+        # moving the twin axis to the front maps the contraction onto one
+        # [2, B, K] @ [2, K, B] batched matmul rather than a dot_general
+        # with a kept trailing axis.
+        # The [B, B] contraction dominates critic FLOPs, so run it in
+        # bfloat16 for tensor-core throughput and halved bandwidth on the
+        # K reduction; the logits come back as fp32 for the loss.
+        sa_t = jnp.transpose(sa_repr, (2, 0, 1)).astype(jnp.bfloat16)
+        fs_t = jnp.transpose(fs_repr, (2, 1, 0)).astype(jnp.bfloat16)
+        return jnp.matmul(sa_t, fs_t).astype(jnp.float32).transpose(1, 2, 0)
 
     # def _critic_fn(obs, action):
     #     sa_repr, g_repr, hidden = _repr_fn(obs, action)
@@ -473,16 +511,17 @@ def make_networks(
     # dummy_action = utils.add_batch_dim(dummy_action)
     # dummy_obs = utils.add_batch_dim(dummy_obs)
 
-    dummy_action = utils.ones_like(spec.actions)
-    dummy_obs = utils.ones_like(spec.observations)[:obs_dim]
-    dummy_future_obs = utils.ones_like(spec.observations)[:obs_dim]
-    dummy_goal = utils.ones_like(spec.observations)[obs_dim:]
-    dummy_obs_and_goal = utils.ones_like(spec.observations)
-    dummy_action = utils.add_batch_dim(dummy_action)
-    dummy_obs = utils.add_batch_dim(dummy_obs)
-    dummy_future_obs = utils.add_batch_dim(dummy_future_obs)
-    dummy_goal = utils.add_batch_dim(dummy_goal)
-    dummy_obs_and_goal = utils.add_batch_dim(dummy_obs_and_goal)
+    # Build the dummies directly on device with jnp.ones instead of
+    # utils.ones_like + add_batch_dim, which allocates host arrays and
+    # transfers each one separately.
+    obs_and_goal_dim = spec.observations.shape[-1]
+    dummy_action = jnp.ones((1,) + spec.actions.shape, spec.actions.dtype)
+    dummy_obs = jnp.ones((1, obs_dim), spec.observations.dtype)
+    dummy_future_obs = jnp.ones((1, obs_dim), spec.observations.dtype)
+    dummy_goal = jnp.ones((1, obs_and_goal_dim - obs_dim),
+                          spec.observations.dtype)
+    dummy_obs_and_goal = jnp.ones((1, obs_and_goal_dim),
+                                  spec.observations.dtype)
 
     # return ContrastiveNetworks(
     #     policy_network=networks_lib.FeedForwardNetwork(